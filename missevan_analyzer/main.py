@@ -1,19 +1,44 @@
 import os
+import atexit
 import json
 import csv
+import pickle
+import functools
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from typing import Dict, List, Set, Optional
 import threading
 import re
+from collections import deque
+from concurrent.futures import CancelledError
+from operator import attrgetter
 
 
-from src.scraper import fetch_episode_list, fetch_danmaku_xml
-from src.parser import parse_danmaku_xml, identify_staff, Danmaku
-from src.analyzer import get_dialogues_by_ids, _get_lines_for_character, analyze_character_mentions
-from src.utils import read_drama_csv, format_time
+from src.scraper import fetch_episode_list, close_session
+from src.parser import identify_staff, Danmaku
+from src.analyzer import (get_dialogues_by_ids, analyze_character_mentions, extract_character_lines,
+                          iter_episode_danmaku, fetch_danmaku_with_status, build_mention_matcher,
+                          shutdown_fetching)
+from src.utils import read_drama_csv, format_time, load_json, DaemonThreadPoolExecutor
 from src.outputter import save_subtitles,show_mention_dialog,save_mention_results
 
+# 弹幕缓存优先用zstd压缩，未安装zstandard时直接保存pickle
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+# 单集弹幕获取失败，由 get_danmaku 捕获后返回None
+class _DanmakuFetchError(Exception):
+    pass
+
+
+# 单集弹幕XML解析不完整，携带已解析出的部分弹幕，不写入内存和磁盘缓存
+class _PartialDanmaku(Exception):
+    def __init__(self, danmaku_list: List[Danmaku]):
+        super().__init__()
+        self.danmaku_list = danmaku_list
 
 
 # 剧集数据管理类
@@ -24,6 +49,15 @@ class DramaDataManager:
         os.makedirs(data_dir, exist_ok=True)
         os.makedirs(config_dir, exist_ok=True)
 
+        # 弹幕缓存目录
+        self.danmaku_dir = os.path.join(data_dir, "danmaku")
+        os.makedirs(self.danmaku_dir, exist_ok=True)
+        self._cached_danmaku = functools.lru_cache(maxsize=256)(self._load_danmaku)
+
+        # 已读取的剧集列表缓存，以CSV文件修改时间判断是否失效
+        self._episode_cache: Dict[int, List[Dict[str, str]]] = {}
+        self._episode_cache_mtime: Dict[int, float] = {}
+
         # 加载剧集信息
         self.drama_info = self.load_drama_info()
 
@@ -31,9 +65,8 @@ class DramaDataManager:
         """从JSON文件加载剧集信息"""
         try:
             drama_file = os.path.join(self.config_dir, "drama.json")
-            with open(drama_file, 'r', encoding='utf-8') as f:
-                dramas = json.load(f)
-                return {drama["id"]: drama["name"] for drama in dramas}
+            dramas = load_json(drama_file)
+            return {drama["id"]: drama["name"] for drama in dramas}
         except FileNotFoundError:
             print(f"警告: 剧集配置文件 {drama_file} 未找到")
             return {}
@@ -61,12 +94,17 @@ class DramaDataManager:
                     progress_callback(f"获取 {self.drama_info.get(drama_id, '未知剧集')} 的剧集列表失败")
                 return False
 
+            # 剧集列表更新后弹幕可能也有变化（新增台词、清空弹幕），丢弃新旧分集的弹幕缓存
+            old_episodes = self.load_drama_data(drama_id) if self.drama_data_exists(drama_id) else []
+            self.clear_danmaku_cache([ep['id'] for ep in old_episodes] + [ep['id'] for ep in episodes])
+
             csv_path = self.get_drama_csv_path(drama_id)
-            with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
+            with open(csv_path, 'w', newline='', encoding='utf-8-sig', buffering=1 << 16) as f:
                 writer = csv.writer(f)
                 writer.writerow(['name', 'id'])
-                for ep in episodes:
-                    writer.writerow([ep['name'], ep['id']])
+                writer.writerows([ep['name'], ep['id']] for ep in episodes)
+            self._episode_cache.pop(drama_id, None)
+            self._episode_cache_mtime.pop(drama_id, None)
 
             if progress_callback:
                 progress_callback(f"成功获取 {self.drama_info.get(drama_id, '未知剧集')} 的 {len(episodes)} 集数据")
@@ -77,15 +115,95 @@ class DramaDataManager:
             return False
 
     def load_drama_data(self, drama_id: int) -> List[Dict[str, str]]:
-        """加载剧集数据"""
-        return read_drama_csv(self.get_drama_csv_path(drama_id))
+        """加载剧集数据，CSV文件未变化时直接返回缓存"""
+        csv_path = self.get_drama_csv_path(drama_id)
+        try:
+            mtime = os.path.getmtime(csv_path)
+        except OSError:
+            return read_drama_csv(csv_path)
+
+        if self._episode_cache_mtime.get(drama_id) == mtime:
+            return self._episode_cache[drama_id]
+
+        episodes = read_drama_csv(csv_path)
+        self._episode_cache[drama_id] = episodes
+        self._episode_cache_mtime[drama_id] = mtime
+        return episodes
+
+    def get_danmaku_cache_path(self, episode_id: str) -> str:
+        """获取单集弹幕缓存文件路径"""
+        suffix = ".pkl.zst" if zstd is not None else ".pkl"
+        return os.path.join(self.danmaku_dir, f"{episode_id}{suffix}")
+
+    def clear_danmaku_cache(self, episode_ids) -> None:
+        """删除指定分集的磁盘弹幕缓存，并清空内存缓存"""
+        for episode_id in set(map(str, episode_ids)):
+            # 压缩与未压缩两种缓存都要删除，以免安装zstandard前后的旧文件残留
+            for suffix in (".pkl.zst", ".pkl"):
+                try:
+                    os.remove(os.path.join(self.danmaku_dir, f"{episode_id}{suffix}"))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"删除弹幕缓存失败: {e}")
+        self._cached_danmaku.cache_clear()
+
+    def get_danmaku(self, episode_id) -> Optional[List[Danmaku]]:
+        """获取单集弹幕，优先使用内存和磁盘缓存，获取失败时返回None"""
+        try:
+            return self._cached_danmaku(str(episode_id))
+        except _DanmakuFetchError:
+            return None
+        except _PartialDanmaku as e:
+            return e.danmaku_list
+
+    def _load_danmaku(self, episode_id: str) -> List[Danmaku]:
+        cache_path = self.get_danmaku_cache_path(episode_id)
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    data = f.read()
+                if zstd is not None:
+                    data = zstd.ZstdDecompressor().decompress(data)
+                return pickle.loads(data)
+            except Exception as e:
+                print(f"读取弹幕缓存 {cache_path} 失败，重新获取: {e}")
+
+        danmaku_list, complete = fetch_danmaku_with_status(episode_id)
+        if danmaku_list is None:
+            # 抛出异常而不是返回None，避免lru_cache记住失败结果
+            raise _DanmakuFetchError(f"获取剧集 {episode_id} 的弹幕失败")
+        if not complete:
+            # 解析出错时只返回本次得到的部分弹幕，下次重新获取
+            raise _PartialDanmaku(danmaku_list)
+
+        if danmaku_list:
+            self._save_danmaku_cache(cache_path, danmaku_list)
+        return danmaku_list
+
+    def _save_danmaku_cache(self, cache_path: str, danmaku_list: List[Danmaku]) -> None:
+        """写入弹幕缓存，写入失败只记录日志，不影响本次获取的结果"""
+        tmp_path = cache_path + ".tmp"
+        try:
+            data = pickle.dumps(danmaku_list, protocol=5)
+            if zstd is not None:
+                data = zstd.ZstdCompressor(level=3).compress(data)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"写入弹幕缓存 {cache_path} 失败: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def get_available_dramas(self) -> List[int]:
-        available = []
-        for drama_id in self.drama_info:  # 修复这里：移除 .data_manager
-            if self.drama_data_exists(drama_id):
-                available.append(drama_id)
-        return available
+        # 一次读取数据目录，代替对每部剧单独检查文件是否存在
+        with os.scandir(self.data_dir) as entries:
+            on_disk = {int(entry.name[:-4]) for entry in entries
+                       if entry.name.endswith('.csv') and entry.name[:-4].isdigit() and entry.is_file()}
+        return [drama_id for drama_id in self.drama_info if drama_id in on_disk]
 
     def get_all_dramas(self) -> List[int]:
         return list(self.drama_info.keys())
@@ -96,18 +214,37 @@ class MissevanAnalyzerApp:
         self.root.title("猫耳FM剧集弹幕分析系统")
         self.root.geometry("800x600")
 
+        # 退出时关闭爬虫的全局会话
+        atexit.register(close_session)
+        # 关闭窗口时取消排队中的抓取任务
+        self._update_executor: Optional[DaemonThreadPoolExecutor] = None
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
+
         # 初始化数据管理器
         self.data_manager = DramaDataManager()
 
+        # 待刷新到界面的进度消息，按文本框分别排队，由工作线程写入、主循环批量取出
+        self._progress_queues: Dict[tk.Text, deque] = {}
+        self._progress_flush_pending: Set[tk.Text] = set()
+
+        # 下拉框与集数列表中每一项对应的剧集ID和集数信息
+        self._drama_id_by_index: List[int] = []
+        self._analysis_drama_id_by_index: List[int] = []
+        self._episodes: List[Dict[str, str]] = []
+
         self.characters = self.load_characters("configs/characters.json")
+        # 角色名列表和各角色的称呼匹配器只在加载角色时构建一次
+        self._all_character_names = list(self.characters.keys())
+        # 与分析时的 exact_match=True 保持一致
+        self._mention_matchers = {char: build_mention_matcher({char: nicknames}, exact_match=True)
+                                  for char, nicknames in self.characters.items()}
         self.create_main_interface()
         self.update_drama_list()
 
     def load_characters(self, json_file: str) -> Dict[str, List[str]]:
         try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get("角色列表", {})
+            data = load_json(json_file)
+            return data.get("角色列表", {})
         except FileNotFoundError:
             messagebox.showerror("错误", f"角色文件 {json_file} 未找到")
             return {}
@@ -242,9 +379,10 @@ class MissevanAnalyzerApp:
         all_dramas = self.data_manager.get_all_dramas()
         drama_names = [f"{self.data_manager.drama_info.get(did, '未知')} ({did})" for did in all_dramas]
 
+        self._drama_id_by_index = all_dramas
         self.drama_combo['values'] = drama_names
         if drama_names:
-            self.drama_var.set(drama_names[0])
+            self.drama_combo.current(0)
 
         self.update_analysis_drama_list()
 
@@ -253,28 +391,28 @@ class MissevanAnalyzerApp:
         available_dramas = self.data_manager.get_available_dramas()
         drama_names = [f"{self.data_manager.drama_info.get(did, '未知')} ({did})" for did in available_dramas]
 
+        self._analysis_drama_id_by_index = available_dramas
         self.analysis_drama_combo['values'] = drama_names
         if drama_names:
-            self.analysis_drama_var.set(drama_names[0])
+            self.analysis_drama_combo.current(0)
             self.on_analysis_drama_selected()
         else:
             self.analysis_drama_var.set("")
+            self._episodes = []
             self.episode_listbox.delete(0, tk.END)
 
     def on_analysis_drama_selected(self, event=None):
-        selected = self.analysis_drama_var.get()
-        if not selected:
+        index = self.analysis_drama_combo.current()
+        if index < 0:
             return
 
-        # 提取剧集ID
-        drama_id = int(selected.split('(')[-1].rstrip(')'))
-
         # 加载剧集数据
-        episodes = self.data_manager.load_drama_data(drama_id)
+        drama_id = self._analysis_drama_id_by_index[index]
+        self._episodes = self.data_manager.load_drama_data(drama_id)
 
         # 更新集数列表
         self.episode_listbox.delete(0, tk.END)
-        for ep in episodes:
+        for ep in self._episodes:
             self.episode_listbox.insert(tk.END, f"{ep['name']} (ID: {ep['id']})")
 
     def select_all_episodes(self):
@@ -286,13 +424,12 @@ class MissevanAnalyzerApp:
         self.episode_listbox.selection_clear(0, tk.END)
 
     def update_selected_drama(self):
-        selected = self.drama_var.get()
-        if not selected:
+        index = self.drama_combo.current()
+        if index < 0:
             messagebox.showwarning("警告", "请先选择要更新的剧集")
             return
 
-        # 提取剧集ID
-        drama_id = int(selected.split('(')[-1].rstrip(')'))
+        drama_id = self._drama_id_by_index[index]
 
         # 在新线程中执行更新
         thread = threading.Thread(target=self._update_drama_data, args=(drama_id,))
@@ -305,7 +442,7 @@ class MissevanAnalyzerApp:
         thread.daemon = True
         thread.start()
 
-    def _update_drama_data(self, drama_id: int):
+    def _update_drama_data(self, drama_id: int, refresh_ui: bool = True) -> bool:
         drama_name = self.data_manager.drama_info.get(drama_id, '未知剧集')
         self.append_progress(f"开始更新 {drama_name} 的数据...")
 
@@ -317,36 +454,63 @@ class MissevanAnalyzerApp:
         if success:
             self.append_progress(f"{drama_name} 数据更新完成")
             # 更新UI
-            self.root.after(100, self.update_drama_list)
+            if refresh_ui:
+                self.root.after(100, self.update_drama_list)
         else:
             self.append_progress(f"{drama_name} 数据更新失败")
+        return success
 
     def _update_all_dramas(self):
         """更新所有剧集数据（在线程中执行）"""
-        for drama_id in self.data_manager.drama_info:
-            self._update_drama_data(drama_id)
+        # 各剧集并发更新，全部完成后统一刷新一次界面；工作线程为守护线程，关闭窗口时不会拖住进程
+        with DaemonThreadPoolExecutor(max_workers=8, thread_name_prefix="drama-update") as executor:
+            self._update_executor = executor
+            try:
+                results = list(executor.map(lambda drama_id: self._update_drama_data(drama_id, refresh_ui=False),
+                                            self.data_manager.drama_info))
+            except CancelledError:
+                return  # 窗口已关闭，剩余剧集不再更新
+
+        if any(results):
+            self.root.after(100, self.update_drama_list)
+
+    def _on_close(self):
+        """关闭窗口，取消所有尚未开始的抓取和更新任务"""
+        shutdown_fetching()
+        if self._update_executor is not None:
+            self._update_executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
     def append_progress(self, message: str):
         """添加进度消息"""
-
-        def _append():
-            self.progress_text.configure(state=tk.NORMAL)
-            self.progress_text.insert(tk.END, message + "\n")
-            self.progress_text.see(tk.END)
-            self.progress_text.configure(state=tk.DISABLED)
-
-        self.root.after(100, _append)
+        self._queue_progress(self.progress_text, message)
 
     def append_analysis_progress(self, message: str):
         """添加分析进度消息"""
+        self._queue_progress(self.analysis_progress_text, message)
+
+    def _queue_progress(self, text_widget: tk.Text, message: str):
+        """消息入队，同一文本框同时只安排一次刷新"""
+        self._progress_queues.setdefault(text_widget, deque()).append(message)
+        if text_widget not in self._progress_flush_pending:
+            self._progress_flush_pending.add(text_widget)
+            self.root.after(50, self._flush_progress, text_widget)
+
+    def _flush_progress(self, text_widget: tk.Text):
+        """将积压的进度消息一次性写入文本框"""
+        # 先清除标记再取消息，避免漏掉取消息期间新加入的消息
+        self._progress_flush_pending.discard(text_widget)
+        queue = self._progress_queues[text_widget]
+        messages = []
+        while queue:
+            messages.append(queue.popleft() + "\n")
+        if not messages:
+            return
 
-        def _append():
-            self.analysis_progress_text.configure(state=tk.NORMAL)
-            self.analysis_progress_text.insert(tk.END, message + "\n")
-            self.analysis_progress_text.see(tk.END)
-            self.analysis_progress_text.configure(state=tk.DISABLED)
-
-        self.root.after(100, _append)
+        text_widget.configure(state=tk.NORMAL)
+        text_widget.insert(tk.END, "".join(messages))
+        text_widget.see(tk.END)
+        text_widget.configure(state=tk.DISABLED)
 
     def browse_output_dir(self):
         """选择输出目录"""
@@ -379,14 +543,15 @@ class MissevanAnalyzerApp:
     def _crawl_subtitles(self, episodes: List[Dict[str, str]], output_dir: str):
         """爬取整集字幕（在线程中执行）"""
         # 获取所有角色名
-        all_character_names = list(self.characters.keys())
+        all_character_names = self._all_character_names
 
         self.append_analysis_progress("开始爬取字幕...")
 
         # 根据用户选择决定是否保存到文件
         if self.save_to_file_var.get():
             save_subtitles(episodes, output_dir, True, all_character_names,
-                           progress_callback=lambda msg: self.append_analysis_progress(msg))
+                           progress_callback=lambda msg: self.append_analysis_progress(msg),
+                           danmaku_loader=self.data_manager.get_danmaku)
             self.append_analysis_progress("字幕爬取完成并已保存到文件")
         else:
             # 如果不保存到文件，则弹窗显示第一集的内容
@@ -398,20 +563,18 @@ class MissevanAnalyzerApp:
 
     def show_subtitles_dialog(self, episode: Dict[str, str], character_names: List[str]):
         # 获取弹幕数据
-        xml_content = fetch_danmaku_xml(episode['id'])
-        if not xml_content:
+        danmaku_list = self.data_manager.get_danmaku(episode['id'])
+        if danmaku_list is None:
             messagebox.showerror("错误", f"获取剧集 {episode['name']} 的字幕失败")
             return
 
-        danmaku_list = parse_danmaku_xml(xml_content)
-
         # 筛选工作人员
         staff_ids = identify_staff(danmaku_list, character_names)
         if staff_ids:
             danmaku_list = get_dialogues_by_ids(danmaku_list, staff_ids)
 
         # 按时间排序
-        danmaku_list.sort(key=lambda d: d.timestamp)
+        danmaku_list = sorted(danmaku_list, key=attrgetter('timestamp'))
 
         # 创建对话框
         dialog = tk.Toplevel(self.root)
@@ -431,8 +594,8 @@ class MissevanAnalyzerApp:
         text_widget.insert(tk.END, f"ID: {episode['id']}\n")
         text_widget.insert(tk.END, "=" * 50 + "\n\n")
 
-        for danmaku in danmaku_list:
-            text_widget.insert(tk.END, f"[{danmaku.formatted_time}] {danmaku.content}\n")
+        # 一次性插入全部字幕，避免逐行调用Tk
+        text_widget.insert(tk.END, "".join(f"[{d.formatted_time}] {d.content}\n" for d in danmaku_list))
 
         text_widget.config(state=tk.DISABLED)
 
@@ -457,22 +620,21 @@ class MissevanAnalyzerApp:
         output_dir = self.output_dir_var.get()
         os.makedirs(output_dir, exist_ok=True)
 
-        all_character_names = list(self.characters.keys())
+        all_character_names = self._all_character_names
         all_lines = []
 
         total = len(episodes)
-        for i, episode in enumerate(episodes):
-            self.append_analysis_progress(f"正在处理 [{i + 1}/{total}]: {episode['name']}")
-
-            xml_content = fetch_danmaku_xml(episode['id'])
-            if xml_content:
-                danmaku_list = parse_danmaku_xml(xml_content)
-                staff_ids = identify_staff(danmaku_list, all_character_names)
-
-                if staff_ids:
-                    all_dialogues = get_dialogues_by_ids(danmaku_list, staff_ids)
-                    char_lines = _get_lines_for_character(all_dialogues, character_name)
-                    all_lines.extend(char_lines)
+        results = [None] * total
+        fetched = iter_episode_danmaku(episodes, danmaku_loader=self.data_manager.get_danmaku)
+        for done, (index, episode, danmaku_list) in enumerate(fetched):
+            self.append_analysis_progress(f"已处理 [{done + 1}/{total}]: {episode['name']}")
+            if danmaku_list:
+                results[index] = extract_character_lines(danmaku_list, character_name, all_character_names)
+
+        # 按剧集顺序汇总台词
+        for char_lines in results:
+            if char_lines:
+                all_lines.extend(char_lines)
 
         # 保存角色台词
         if self.save_to_file_var.get():
@@ -508,8 +670,7 @@ class MissevanAnalyzerApp:
         text_widget.insert(tk.END, f"台词数量: {len(lines)}\n")
         text_widget.insert(tk.END, "=" * 50 + "\n\n")
 
-        for line in lines:
-            text_widget.insert(tk.END, f"[{line.formatted_time}] {line.content}\n")
+        text_widget.insert(tk.END, "".join(f"[{line.formatted_time}] {line.content}\n" for line in lines))
 
         text_widget.config(state=tk.DISABLED)
 
@@ -545,7 +706,9 @@ class MissevanAnalyzerApp:
         results = analyze_character_mentions(
             episodes, main_character, target_chars_dict,
             progress_callback=lambda msg: self.append_analysis_progress(msg),
-            exact_match=True  # 启用精确匹配
+            exact_match=True,  # 启用精确匹配
+            danmaku_loader=self.data_manager.get_danmaku,
+            matcher=self._mention_matchers[target_character]
         )
 
         # 根据用户选择决定是否保存文件
@@ -561,15 +724,10 @@ class MissevanAnalyzerApp:
         self.append_analysis_progress("统计结果显示在对话框中")
 
     def get_selected_episodes(self) -> List[Dict[str, str]]:
-        selected = self.analysis_drama_var.get()
-        if not selected:
+        if self.analysis_drama_combo.current() < 0:
             messagebox.showwarning("错误", "请先选择剧集")
             return []
 
-        # 提取剧集ID
-        drama_id = int(selected.split('(')[-1].rstrip(')'))
-        # 加载剧集数据
-        all_episodes = self.data_manager.load_drama_data(drama_id)
         # 获取选中的集数索引
         selected_indices = self.episode_listbox.curselection()
         if not selected_indices:
@@ -577,7 +735,7 @@ class MissevanAnalyzerApp:
             return []
 
         # 返回选中的集数
-        return [all_episodes[i] for i in selected_indices]
+        return [self._episodes[i] for i in selected_indices]
 
     def show_character_selection_dialog(self, title: str, callback, multiple: bool = False):
         dialog = tk.Toplevel(self.root)
@@ -1,33 +1,123 @@
 import re
-import time
+import sys
 import random
-from collections import defaultdict
-from typing import List, Dict, Tuple, Set
+import threading
+from concurrent.futures import as_completed
+from operator import attrgetter
+from typing import List, Dict, Tuple, Set, Optional
 
 from .scraper import fetch_danmaku_xml
-from .parser import parse_danmaku_xml, identify_staff, Danmaku
+from .parser import parse_danmaku_xml_with_status, identify_staff, Danmaku
+from .utils import DaemonThreadPoolExecutor
+
+# 多模式匹配优先使用pyahocorasick，未安装时退回正则
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# 多人台词中按句末标点切分
+_SENT_SPLIT_RE = re.compile(r'[。！？；]')
+
+# 并发爬取弹幕的线程数
+FETCH_WORKERS = 10
 
 # 筛选指定ID发言
 def get_dialogues_by_ids(danmaku_list: List[Danmaku], user_ids: Set[str]) -> List[Danmaku]:
+    # 传入列表等其他容器时先转成集合，保证逐条判断是O(1)
+    if not isinstance(user_ids, (set, frozenset)):
+        user_ids = frozenset(user_ids)
+    # 先筛选再排序，排序键对每条只求一次
     dialogues = [d for d in danmaku_list if d.user_id in user_ids]
-    dialogues.sort(key=lambda d: d.timestamp)
+    dialogues.sort(key=attrgetter('timestamp'))
     return dialogues
 
+# 爬取并解析指定声音ID的弹幕，爬取失败时返回None
+def fetch_danmaku(sound_id: str) -> Optional[List[Danmaku]]:
+    return fetch_danmaku_with_status(sound_id)[0]
+
+# 同 fetch_danmaku，另外返回XML是否完整解析，供缓存判断是否可以保存
+def fetch_danmaku_with_status(sound_id: str) -> Tuple[Optional[List[Danmaku]], bool]:
+    # 随机延迟，在各抓取线程内错开请求；命中缓存时不会走到这里。
+    # 窗口关闭后等待会被立即唤醒，不再发起新的请求
+    if _STOP_FETCHING.wait(random.uniform(1.0, 2.5)):
+        return None, False
+    xml_content = fetch_danmaku_xml(sound_id)
+    if not xml_content:
+        return None, False
+    return parse_danmaku_xml_with_status(xml_content)
+
+# 获取单集弹幕，传入角色名时只保留工作人员发布的台词；获取失败时返回None
+def _fetch_and_parse(episode: Dict[str, str], character_names: List[str] = None,
+                     danmaku_loader=fetch_danmaku) -> Tuple[Dict[str, str], Optional[List[Danmaku]]]:
+    danmaku_list = danmaku_loader(episode['id'])
+    if danmaku_list is None:
+        return episode, None
+
+    if character_names:
+        staff_ids = identify_staff(danmaku_list, character_names)
+        danmaku_list = get_dialogues_by_ids(danmaku_list, staff_ids)
+    return episode, danmaku_list
+
+# 全局复用的抓取线程池，各项分析共用，避免每次点击都重新创建线程；
+# 工作线程为守护线程，关闭窗口后不会因正在进行的请求或重试拖住进程
+_FETCH_EXECUTOR = DaemonThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="danmaku-fetch")
+
+# 窗口关闭后置位，正在等待的抓取任务随即放弃
+_STOP_FETCHING = threading.Event()
+
+# 停止抓取：取消排队中的任务，并让正在等待延迟的任务不再发起请求，窗口关闭时调用
+def shutdown_fetching() -> None:
+    _STOP_FETCHING.set()
+    _FETCH_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+# 并发获取多集弹幕，按完成先后给出 (原序号, 剧集, 弹幕列表)
+def iter_episode_danmaku(episodes: List[Dict[str, str]], character_names: List[str] = None,
+                         danmaku_loader=fetch_danmaku):
+    futures = {_FETCH_EXECUTOR.submit(_fetch_and_parse, episode, character_names, danmaku_loader): i
+               for i, episode in enumerate(episodes)}
+    for future in as_completed(futures):
+        episode, danmaku_list = future.result()
+        yield futures[future], episode, danmaku_list
+
 # 筛选特定角色台词
 def _get_lines_for_character(all_dialogues: List[Danmaku], character_name: str) -> List[Danmaku]:
     """
     筛选逻辑为寻找某角色首次发言的颜色，用该颜色过滤所有台词。
     """
+    prefix = f"{character_name}："
+    startswith = str.startswith
+    char_colors = {d.color for d in all_dialogues if startswith(d.content, prefix)}
+
+    # 每条带前缀的台词都会贡献颜色，没有颜色即没有任何该角色的台词
+    if not char_colors:
+        return []
+
+    return [d for d in all_dialogues if d.color in char_colors]
+
+# 从整集弹幕中直接筛出某角色的台词，等价于依次调用
+# identify_staff、get_dialogues_by_ids、_get_lines_for_character，但只遍历整集弹幕两次
+def extract_character_lines(danmaku_list: List[Danmaku], character_name: str,
+                            character_names: List[str]) -> List[Danmaku]:
+    staff_ids = identify_staff(danmaku_list, character_names)
+    if not staff_ids:
+        return []
+
+    prefix = f"{character_name}："
+    staff_dialogues = []
     char_colors = set()
-    for dialogue in all_dialogues:
-        if dialogue.content.startswith(f"{character_name}："):
-            char_colors.add(dialogue.color)
+    for d in danmaku_list:
+        if d.user_id in staff_ids:
+            staff_dialogues.append(d)
+            if d.content.startswith(prefix):
+                char_colors.add(d.color)
 
-    if char_colors:
-        return [d for d in all_dialogues if d.color in char_colors]
+    if not char_colors:
+        return []
 
-    # 如果没有找到特定颜色（或颜色不唯一），只匹配前缀
-    return [d for d in all_dialogues if d.content.startswith(f"{character_name}：")]
+    lines = [d for d in staff_dialogues if d.color in char_colors]
+    lines.sort(key=attrgetter('timestamp'))
+    return lines
 
 # 多人同时说话判定
 def extract_mainchar_speech(content, main_char):
@@ -58,7 +148,7 @@ def extract_mainchar_speech(content, main_char):
 
             # 当内容分割不一致时，尝试匹配主角色特有的说话模式
             # 查找包含主角色名的内容片段
-            for segment in re.split(r'[。！？；]', content_part):
+            for segment in _SENT_SPLIT_RE.split(content_part):
                 if main_char in segment:
                     return segment.strip()
 
@@ -72,85 +162,148 @@ def extract_mainchar_speech(content, main_char):
     # 不是多人说话格式，直接返回整个内容
     return content
 
-# 新的昵称匹配和计数函数
-def count_mentions_in_content(content, target_characters, exact_match=False):
-
-    counts = defaultdict(lambda: defaultdict(int))
-    
-    # 先收集所有可能的匹配
-    all_matches = []
+# 构建称呼匹配器，返回的函数从左到右给出内容中互不重叠的 (角色, 昵称)
+# 同一位置能匹配多个昵称时，取配置中排在前面的那个
+# exact_match=True 时与 re.finditer 逐个昵称查找一致：同一昵称自身的重叠出现只取靠前的一次，
+# 例如 "向安安安" 中 "安安" 只算一次候选，最终得到 {向安: 1}；否则同一昵称的每次出现都参与候选
+def build_mention_matcher(target_characters: Dict[str, List[str]], exact_match: bool = False):
+    entries = []
+    seen = set()
     for char, nicknames in target_characters.items():
         for nickname in nicknames:
-            if exact_match:
-                # 使用正则表达式进行精确匹配
-                pattern = re.escape(nickname)
-                matches = re.finditer(pattern, content)
-                for match in matches:
-                    all_matches.append((char, nickname, match.start(), match.end()))
-            else:
-                # 使用简单的字符串查找
-                start = 0
-                while True:
-                    pos = content.find(nickname, start)
-                    if pos == -1:
-                        break
-                    all_matches.append((char, nickname, pos, pos + len(nickname)))
-                    start = pos + 1
-    
-    # 按起始位置排序
-    all_matches.sort(key=lambda x: x[2])
-    
-    # 找出不重叠的匹配
-    non_overlapping = []
-    last_end = -1
-    for match in all_matches:
-        char, nickname, start, end = match
-        if start >= last_end:
-            non_overlapping.append((char, nickname))
-            last_end = end
-    
-    # 统计不重叠的匹配
-    for char, nickname in non_overlapping:
-        counts[char][nickname] += 1
-    
+            if nickname and nickname not in seen:
+                nickname = sys.intern(nickname)
+                seen.add(nickname)
+                entries.append((sys.intern(char), nickname))
+
+    if not entries:
+        return lambda content: []
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for priority, (char, nickname) in enumerate(entries):
+            automaton.add_word(nickname, (len(nickname), priority, char, nickname))
+        automaton.make_automaton()
+
+        def find_mentions(content):
+            # 自动机按结束位置给出所有（含重叠的）匹配；同一起点只可能选中优先级最高的那个，
+            # 因此按起点分桶只保留一个，再按起点顺序去重叠
+            best_by_start = {}
+            last_end_by_nickname = {}
+            for end, (length, priority, char, nickname) in automaton.iter(content):
+                start = end - length + 1
+                if exact_match:
+                    # 同一昵称的匹配按结束位置依次给出，与上一次重叠的跳过
+                    if start <= last_end_by_nickname.get(nickname, -1):
+                        continue
+                    last_end_by_nickname[nickname] = end
+                current = best_by_start.get(start)
+                if current is None or priority < current[0]:
+                    best_by_start[start] = (priority, char, nickname, length)
+
+            if len(best_by_start) <= 1:
+                # 绝大多数台词至多命中一个起点，无需排序和去重叠
+                return [(char, nickname) for _, char, nickname, _ in best_by_start.values()]
+
+            mentions = []
+            last_end = 0
+            for start in sorted(best_by_start):
+                if start >= last_end:
+                    _, char, nickname, length = best_by_start[start]
+                    mentions.append((char, nickname))
+                    last_end = start + length
+            return mentions
+    elif exact_match:
+        # 每个昵称单独 finditer 收集候选，再按起点（同起点按配置顺序）取互不重叠的匹配
+        patterns = [(char, nickname, re.compile(re.escape(nickname))) for char, nickname in entries]
+
+        def find_mentions(content):
+            candidates = [(m.start(), priority, m.end(), char, nickname)
+                          for priority, (char, nickname, pattern) in enumerate(patterns)
+                          if nickname in content
+                          for m in pattern.finditer(content)]
+            candidates.sort()
+
+            mentions = []
+            last_end = 0
+            for start, _, end, char, nickname in candidates:
+                if start >= last_end:
+                    mentions.append((char, nickname))
+                    last_end = end
+            return mentions
+    else:
+        # 正则的多选分支本身就是从左到右、按分支顺序取第一个匹配且互不重叠，
+        # 分支保持配置顺序（而非按长度排序），与自动机分支的优先级规则一致
+        pattern = re.compile("|".join(re.escape(nickname) for _, nickname in entries))
+        nickname_to_char = {nickname: char for char, nickname in entries}
+        findall = pattern.findall
+
+        def find_mentions(content):
+            return [(nickname_to_char[nickname], nickname) for nickname in findall(content)]
+
+    return find_mentions
+
+# 昵称匹配和计数函数
+# 传入 matcher 时需与 exact_match 使用相同模式构建
+def count_mentions_in_content(content, target_characters, exact_match=False, matcher=None):
+
+    if matcher is None:
+        matcher = build_mention_matcher(target_characters, exact_match)
+
+    counts: Dict[str, Dict[str, int]] = {}
+    for char, nickname in matcher(content):
+        _bump(counts, char, nickname, 1)
+
     return counts
 
+# 嵌套计数 角色 -> 昵称 -> 次数 加n，用普通字典代替defaultdict，省去工厂函数调用
+def _bump(counts: Dict[str, Dict[str, int]], char: str, nickname: str, n: int) -> None:
+    sub = counts.get(char)
+    if sub is None:
+        sub = counts[char] = {}
+    sub[nickname] = sub.get(nickname, 0) + n
+
 # 分析剧集中互相称呼次数
 def analyze_character_mentions(
         episodes: List[Dict[str, str]],
         main_character: str,
         target_characters: Dict[str, List[str]],
         progress_callback=None,
-        exact_match=False
+        exact_match=False,
+        danmaku_loader=fetch_danmaku,
+        matcher=None
 ) -> Dict:
     # 嵌套字典，用于存储总统计：角色 -> 昵称 -> 次数
-    total_mention_counts = defaultdict(lambda: defaultdict(int))
+    total_mention_counts: Dict[str, Dict[str, int]] = {}
     per_episode_results = []
 
+    # 称呼匹配器只构建一次，供所有剧集的所有台词复用
+    if matcher is None:
+        matcher = build_mention_matcher(target_characters, exact_match)
+    min_nickname_len = min((len(n) for nicks in target_characters.values() for n in nicks if n), default=0)
+
     # 获取所有可能需要匹配的角色名（用于识别工作人员）
     all_character_names = list(target_characters.keys()) + [main_character]
 
     total_episodes = len(episodes)
-    for i, episode in enumerate(episodes):
+    # 所有剧集的弹幕提交到线程池并发获取，分析仍按剧集顺序进行
+    fetched = _FETCH_EXECUTOR.map(danmaku_loader, [episode['id'] for episode in episodes])
+    for i, (episode, danmaku_list) in enumerate(zip(episodes, fetched)):
         ep_name, ep_id = episode['name'], episode['id']
         if progress_callback:
             progress_callback(f"[{i + 1}/{total_episodes}] 正在处理: {ep_name} (ID: {ep_id})")
         else:
             print(f"\n[{i + 1}/{total_episodes}] 正在处理: {ep_name} (ID: {ep_id})")
 
-        # 1. 爬取数据
-        xml_content = fetch_danmaku_xml(ep_id)
-        if not xml_content:
+        # 1. 检查获取结果
+        if danmaku_list is None:
             if progress_callback:
                 progress_callback(f"获取弹幕失败，跳过本集。")
             else:
                 print(f"获取弹幕失败，跳过本集。")
             continue
 
-        # 2. 解析数据
-        danmaku_list = parse_danmaku_xml(xml_content)
-
-        # 3. 分析数据
+        # 2. 分析数据
         staff_ids = identify_staff(danmaku_list, all_character_names)
         if not staff_ids:
             if progress_callback:
@@ -162,40 +315,46 @@ def analyze_character_mentions(
         all_dialogues = get_dialogues_by_ids(danmaku_list, staff_ids)
         main_char_lines = _get_lines_for_character(all_dialogues, main_character)
 
-        # 4. 统计提及次数和详细对话
-        episode_counts = defaultdict(lambda: defaultdict(int))
-        episode_detailed_mentions = defaultdict(lambda: defaultdict(list))
+        # 3. 统计提及次数和详细对话
+        episode_counts: Dict[str, Dict[str, int]] = {}
+        episode_detailed_mentions: Dict[str, Dict[str, List[Tuple[Danmaku, int]]]] = {}
 
         for line in main_char_lines:
             # 提取主角色实际说话内容（处理多人说话场景）
             actual_content = extract_mainchar_speech(line.content, main_character)
-            if actual_content is None:
-                continue  # 跳过这条弹幕
+            if actual_content is None or len(actual_content) < min_nickname_len:
+                continue  # 跳过这条弹幕，比最短昵称还短的内容不可能有提及
+
+            # 大部分台词没有任何提及，先直接跑一遍匹配器，没有命中就不再构建计数字典
+            mentions = matcher(actual_content)
+            if not mentions:
+                continue
+
+            # 统计提及次数
+            line_counts: Dict[str, Dict[str, int]] = {}
+            for char, nickname in mentions:
+                _bump(line_counts, char, nickname, 1)
 
-            # 使用新的函数统计提及次数
-            line_counts = count_mentions_in_content(actual_content, target_characters, exact_match)
-            
             # 更新统计结果
             for char, nick_counts in line_counts.items():
                 for nickname, count in nick_counts.items():
-                    episode_counts[char][nickname] += count
-                    total_mention_counts[char][nickname] += count
-                    # 添加详细提及
-                    for _ in range(count):
-                        episode_detailed_mentions[char][nickname].append(line)
+                    _bump(episode_counts, char, nickname, count)
+                    _bump(total_mention_counts, char, nickname, count)
+                    # 添加详细提及，记录台词及其中的提及次数
+                    detailed = episode_detailed_mentions.get(char)
+                    if detailed is None:
+                        detailed = episode_detailed_mentions[char] = {}
+                    detailed.setdefault(nickname, []).append((line, count))
 
         per_episode_results.append({
             "name": ep_name,
             "id": ep_id,
             "main_char_lines": len(main_char_lines),
-            "mentions": dict(episode_counts),
-            "detailed_mentions": dict(episode_detailed_mentions)
+            "mentions": episode_counts,
+            "detailed_mentions": episode_detailed_mentions
         })
 
-        # 随机延迟
-        time.sleep(random.uniform(1.0, 2.5))
-
     return {
-        "total_mentions": dict(total_mention_counts),
+        "total_mentions": total_mention_counts,
         "per_episode_details": per_episode_results
     }
\ No newline at end of file
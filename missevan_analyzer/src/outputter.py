@@ -1,47 +1,52 @@
 import os
 import csv
-from typing import List, Dict
+from operator import attrgetter
+from typing import List, Dict, Tuple
 
 from .parser import Danmaku
-from .scraper import fetch_danmaku_xml
-from .parser import parse_danmaku_xml, identify_staff
-from .analyzer import get_dialogues_by_ids
+from .utils import format_times
+from .analyzer import iter_episode_danmaku, fetch_danmaku
 
 
 def save_subtitles(episodes: List[Dict[str, str]], output_dir: str,
                    filter_staff: bool = True, character_names: List[str] = None,
-                   progress_callback=None) -> None:  # 添加 progress_callback 参数
+                   progress_callback=None, danmaku_loader=fetch_danmaku) -> None:
 
     os.makedirs(output_dir, exist_ok=True)
 
-    for i, episode in enumerate(episodes):
+    names = character_names if filter_staff else None
+    fetched = iter_episode_danmaku(episodes, names, danmaku_loader)
+    for i, (_, episode, danmaku_list) in enumerate(fetched):
         if progress_callback:
-            progress_callback(f"正在处理 [{i + 1}/{len(episodes)}]: {episode['name']}")
+            progress_callback(f"已处理 [{i + 1}/{len(episodes)}]: {episode['name']}")
 
-
-        xml_content = fetch_danmaku_xml(episode['id'])
-        if not xml_content:
+        if danmaku_list is None:
             continue
 
-        danmaku_list = parse_danmaku_xml(xml_content)
-
-        # 筛选工作人员
-        if filter_staff and character_names:
-            staff_ids = identify_staff(danmaku_list, character_names)
-            danmaku_list = get_dialogues_by_ids(danmaku_list, staff_ids)
-
         # 按时间排序
-        danmaku_list.sort(key=lambda d: d.timestamp)
+        danmaku_list = sorted(danmaku_list, key=attrgetter('timestamp'))
 
         # 保存文件
         filename = f"{output_dir}/{episode['name'].replace('/', '_')}.txt"
         with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"剧集: {episode['name']}\n")
-            f.write(f"ID: {episode['id']}\n")
-            f.write("=" * 50 + "\n\n")
-
-            for danmaku in danmaku_list:
-                f.write(f"[{danmaku.formatted_time}] {danmaku.content}\n")
+            f.write(f"剧集: {episode['name']}\nID: {episode['id']}\n" + "=" * 50 + "\n\n")
+            # 一次写出整集台词，避免逐行调用 write
+            times = format_times([d.timestamp for d in danmaku_list])
+            f.write("".join([f"[{t}] {d.content}\n" for t, d in zip(times, danmaku_list)]))
+
+# 格式化一条提及台词，同一句台词多次提及时标注次数
+def _format_mention(dialogue: Danmaku, count: int) -> str:
+    times = f"×{count} " if count > 1 else ""
+    return f"  [{dialogue.formatted_time}] {times}{dialogue.content}\n"
+
+# 筛选出提到目标角色的剧集，返回 (剧集, 该角色的昵称计数)，供各输出共用
+def _episodes_mentioning(results: Dict, target_character: str) -> List[Tuple[Dict, Dict[str, int]]]:
+    relevant = []
+    for episode in results["per_episode_details"]:
+        nicknames = episode['mentions'].get(target_character)
+        if nicknames and any(nicknames.values()):
+            relevant.append((episode, nicknames))
+    return relevant
 
 def save_mention_results(results: Dict, main_character: str, target_character: str,
                          output_dir: str, include_dialogues: bool = True) -> None:
@@ -53,49 +58,37 @@ def save_mention_results(results: Dict, main_character: str, target_character: s
     txt_filename = f"{output_dir}/{base_filename}.txt"
     csv_filename = f"{output_dir}/{base_filename}.csv"
 
+    relevant = _episodes_mentioning(results, target_character)
+
     # 保存TXT文件
     with open(txt_filename, 'w', encoding='utf-8') as f:
         f.write(f"角色称呼统计 - {main_character} -> {target_character}\n")
         f.write("=" * 50 + "\n\n")
 
         # 按剧集分组
-        for episode in results["per_episode_details"]:
-            has_mentions = any(
-                char == target_character and any(nicknames.values())
-                for char, nicknames in episode['mentions'].items()
-            )
-
-            if not has_mentions:
-                continue
-
+        for episode, _ in relevant:
             f.write(f"\n{episode['name']}:\n")
             f.write(f"主角台词数: {episode['main_char_lines']}\n")
 
             # 添加具体对话
             if include_dialogues and 'detailed_mentions' in episode:
                 f.write("\n具体提及:\n")
-                for char, nicknames in episode['detailed_mentions'].items():
-                    if char != target_character:
-                        continue
-
-                    for nickname, dialogues in nicknames.items():
-                        if dialogues:
-                            f.write(f"\n{nickname}:\n")
-                            for dialogue in dialogues:
-                                f.write(f"  [{dialogue.formatted_time}] {dialogue.content}\n")
+                for nickname, dialogues in episode['detailed_mentions'].get(target_character, {}).items():
+                    if dialogues:
+                        f.write(f"\n{nickname}:\n")
+                        for dialogue, count in dialogues:
+                            f.write(_format_mention(dialogue, count))
 
     # 保存CSV文件
     with open(csv_filename, 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f)
         writer.writerow(['剧集', '角色', '昵称', '次数', '主角台词数'])
 
-        for episode in results["per_episode_details"]:
-            for char, nicknames in episode['mentions'].items():
-                if char != target_character:
-                    continue
-
-                for nickname, count in nicknames.items():
-                    writer.writerow([episode['name'], char, nickname, count, episode['main_char_lines']])
+        writer.writerows(
+            [episode['name'], target_character, nickname, count, episode['main_char_lines']]
+            for episode, nicknames in relevant
+            for nickname, count in nicknames.items()
+        )
 
 
 # 显示提及统计结果的对话框
@@ -136,49 +129,36 @@ def show_mention_dialog(parent, results: Dict, main_character: str, target_chara
     details_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
     details_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-    # 添加统计信息
-    stats_text.insert(tk.END, f"角色称呼统计 - {main_character} -> {target_character}\n")
-    stats_text.insert(tk.END, "=" * 50 + "\n\n")
+    # 添加统计信息，先在Python中拼好整段文本，每个文本框只插入一次
+    stats_chunks = [f"角色称呼统计 - {main_character} -> {target_character}\n", "=" * 50 + "\n\n"]
 
     total_count = 0
-    for char, nicknames in results["total_mentions"].items():
-        if char != target_character:
-            continue
+    for nickname, count in results["total_mentions"].get(target_character, {}).items():
+        total_count += count
+        stats_chunks.append(f"{nickname}: {count}次\n")
 
-        for nickname, count in nicknames.items():
-            total_count += count
-            stats_text.insert(tk.END, f"{nickname}: {count}次\n")
-
-    stats_text.insert(tk.END, f"\n总计: {total_count}次\n")
+    stats_chunks.append(f"\n总计: {total_count}次\n")
 
     # 添加详细内容
-    details_text.insert(tk.END, f"{main_character}对{target_character}的称呼详情\n")
-    details_text.insert(tk.END, "=" * 50 + "\n\n")
-
-    for episode in results["per_episode_details"]:
-        has_mentions = any(
-            char == target_character and any(nicknames.values())
-            for char, nicknames in episode['mentions'].items()
-        )
+    details_chunks = [f"{main_character}对{target_character}的称呼详情\n", "=" * 50 + "\n\n"]
 
-        if not has_mentions:
-            continue
+    for episode, nicknames in _episodes_mentioning(results, target_character):
+        details_chunks.append(f"\n{episode['name']}:\n")
 
-        details_text.insert(tk.END, f"\n{episode['name']}:\n")
-
-        for char, nicknames in episode['mentions'].items():
-            if char != target_character:
-                continue
+        for nickname, count in nicknames.items():
+            if count > 0:
+                details_chunks.append(f"\n{nickname} ({count}次):\n")
 
-            for nickname, count in nicknames.items():
-                if count > 0:
-                    details_text.insert(tk.END, f"\n{nickname} ({count}次):\n")
+                # 添加具体对话
+                if 'detailed_mentions' in episode:
+                    details_chunks.extend(
+                        _format_mention(dialogue, mention_count)
+                        for dialogue, mention_count in episode['detailed_mentions'][target_character][nickname]
+                    )
 
-                    # 添加具体对话
-                    if 'detailed_mentions' in episode:
-                        for dialogue in episode['detailed_mentions'][char][nickname]:
-                            details_text.insert(tk.END, f"  [{dialogue.formatted_time}] {dialogue.content}\n")
+    stats_text.insert(tk.END, "".join(stats_chunks))
+    details_text.insert(tk.END, "".join(details_chunks))
 
     # 禁用编辑
     stats_text.config(state=tk.DISABLED)
-    details_text.config(state=tk.DISABLED)
\ No newline at end of file
+    details_text.config(state=tk.DISABLED)
@@ -1,15 +1,33 @@
 # 数据解析模块
 
+import io
 import re
-import xml.etree.ElementTree as ET
+import sys
 from dataclasses import dataclass
-from collections import defaultdict
-from typing import List, Set
+from typing import List, Dict, Set, Tuple, Union
 
 from .utils import format_time
 
+# 优先使用lxml的C解析器，未安装时退回标准库
+try:
+    from lxml import etree as ET
+    _HAS_LXML = True
+    # 遇到个别格式错误的弹幕时跳过继续解析，而不是整集失败
+    _ITERPARSE_OPTIONS = {'recover': True}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _HAS_LXML = False
+    _ITERPARSE_OPTIONS = {}
 
-@dataclass
+# 标准库的节点没有 getparent，需要从start事件拿到根节点，才能摘除已处理的子节点
+_ITERPARSE_EVENTS = ('end',) if _HAS_LXML else ('start', 'end')
+
+# 匹配 "任意中文名：内容" 的台词格式
+_STAFF_RE = re.compile(r"^([^\x00-\xff]+)：")
+
+
+# 使用__slots__去掉每个实例的__dict__，单集弹幕数以千计时能明显减少内存
+@dataclass(slots=True)
 class Danmaku:
     timestamp: float
     user_id: str
@@ -21,41 +39,82 @@ class Danmaku:
         return format_time(self.timestamp)
 
 
-def parse_danmaku_xml(xml_content: str) -> List[Danmaku]:
+def parse_danmaku_xml(xml_content: Union[str, bytes]) -> List[Danmaku]:
+    return parse_danmaku_xml_with_status(xml_content)[0]
+
+
+# 解析弹幕XML，同时返回解析是否完整；XML有错误时只得到部分弹幕，不应长期缓存
+def parse_danmaku_xml_with_status(xml_content: Union[str, bytes]) -> Tuple[List[Danmaku], bool]:
     if not xml_content:
-        return []
+        return [], True
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode('utf-8')
 
     danmaku_list = []
+    complete = True
     try:
-        root = ET.fromstring(xml_content)
-        for d_element in root.findall('d'):
-            p_attributes = d_element.get('p', '').split(',')
-            content = d_element.text or ''
+        # 流式解析，逐条处理<d>节点
+        context = ET.iterparse(io.BytesIO(xml_content), events=_ITERPARSE_EVENTS, **_ITERPARSE_OPTIONS)
+        root = None
+        for event, d_element in context:
+            if event == 'start':
+                if root is None:
+                    root = d_element
+                continue
+            if d_element.tag != 'd':
+                continue
+
+            # 只需要前7个字段，最多切7刀，第7个字段之后的内容不再逐个拆分
+            p_attributes = (d_element.get('p') or '').split(',', 7)
 
             if len(p_attributes) >= 7:
+                content = d_element.text
+                # 用户ID和颜色取值很少且反复出现，驻留后同值共享一个对象；
+                # 内容几乎各不相同，驻留只会让字符串常驻内存，因此不做处理
                 danmaku_list.append(Danmaku(
-                    timestamp=float(p_attributes[0]),
-                    user_id=p_attributes[6],
-                    color=p_attributes[3],
-                    content=content.strip()
+                    float(p_attributes[0]),
+                    sys.intern(p_attributes[6]),
+                    sys.intern(p_attributes[3]),
+                    content.strip() if content else ''
                 ))
+
+            # 释放已处理的节点，并从父节点上摘除，避免整棵树常驻内存
+            d_element.clear()
+            if _HAS_LXML:
+                while d_element.getprevious() is not None:
+                    del d_element.getparent()[0]
+            else:
+                # 弹幕节点都是根节点的直接子节点，处理完一条后根节点下已解析出的子节点都可丢弃
+                del root[:]
+        # lxml在recover模式下会跳过坏节点而不抛异常，错误记录在error_log中
+        if _HAS_LXML and len(context.error_log):
+            print(f"XML解析错误，已跳过无法解析的内容: {context.error_log.last_error}")
+            complete = False
     except ET.ParseError as e:
         print(f"XML解析错误: {e}")
+        complete = False
 
-    return danmaku_list
+    return danmaku_list, complete
 
 
 # 通过台词格式识别并筛选出工作人员（发布台词）的用户ID。
 def identify_staff(danmaku_list: List[Danmaku], character_names: List[str], threshold: int = 5) -> Set[str]:
-    counts = defaultdict(int)
-    # 匹配 "任意中文名：内容" 的格式
-    pattern = re.compile(r"^([^\x00-\xff]+)：")
-
-    for danmaku in danmaku_list:
-        match = pattern.match(danmaku.content)
-        if match:
-            counts[danmaku.user_id] += 1
-
-    # 筛选出发送超过指定条数台词的用户ID
-    staff_ids = {user_id for user_id, count in counts.items() if count > threshold}
-    return staff_ids
\ No newline at end of file
+    match = _STAFF_RE.match
+    counts: Dict[str, int] = {}
+    staff_ids = set()
+    for d in danmaku_list:
+        user_id = d.user_id
+        # 已确认为工作人员的用户无需再计数，也不必再跑正则
+        if user_id in staff_ids:
+            continue
+        content = d.content
+        # 先用 in 检查全角冒号，大部分观众弹幕不含冒号，无需进入正则
+        if '：' in content and match(content):
+            count = counts.get(user_id, 0) + 1
+            # 发送超过指定条数台词即视为工作人员
+            if count > threshold:
+                staff_ids.add(user_id)
+                counts.pop(user_id, None)
+            else:
+                counts[user_id] = count
+    return staff_ids
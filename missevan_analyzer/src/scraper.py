@@ -1,10 +1,19 @@
+import threading
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from typing import Optional, List, Dict
 
+# 限制同时向猫耳FM发起的弹幕请求数，避免并发过高被封禁
+_REQUEST_SEMAPHORE = threading.Semaphore(8)
 
+_SESSION: Optional[requests.Session] = None
+
+
+# 已构建过会话时直接复用，保证整个运行期间只有一个连接池
 def _get_robust_session() -> requests.Session:
+    if _SESSION is not None:
+        return _SESSION
     session = requests.Session()
     retry_strategy = Retry(
         total=5,
@@ -12,7 +21,7 @@ def _get_robust_session() -> requests.Session:
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=["GET"]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retry_strategy)
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     session.headers.update({
@@ -21,26 +30,49 @@ def _get_robust_session() -> requests.Session:
     return session
 
 
-def fetch_page_content(url: str) -> Optional[str]:
-    session = _get_robust_session()
+# 全局复用的会话，保持连接池内的长连接，避免每次请求重新握手
+_SESSION = _get_robust_session()
+
+
+# 关闭全局会话，释放连接池中的长连接，程序退出时调用
+def close_session() -> None:
+    _SESSION.close()
+
+
+def _fetch_response(url: str) -> Optional[requests.Response]:
     try:
         # 连接超时3秒, 读取超时30秒
-        response = session.get(url, timeout=(3, 30))
+        response = _SESSION.get(url, timeout=(3, 30))
         response.raise_for_status()  # 状态码不是2xx，则抛出异常
-        response.encoding = 'utf-8'
-        return response.text
+        return response
     except requests.exceptions.RequestException as e:
         print(f"请求失败: {url} - {e}")
         return None
 
 
+def fetch_page_content(url: str) -> Optional[str]:
+    response = _fetch_response(url)
+    if response is None:
+        return None
+    response.encoding = 'utf-8'
+    return response.text
+
+
+# 获取原始字节，供XML解析器自行处理编码，省去一次解码
+def fetch_page_bytes(url: str) -> Optional[bytes]:
+    response = _fetch_response(url)
+    if response is None:
+        return None
+    return response.content
+
+
 # 通过API获取指定广播剧的所有分集名称和ID
 def fetch_episode_list(drama_id: int) -> List[Dict[str, str]]:
     api_url = f"https://www.missevan.com/dramaapi/getdrama?drama_id={drama_id}"
     print(f"正在从API获取剧集列表: {api_url}")
-    session = _get_robust_session()
     try:
-        response = session.get(api_url)
+        # 与弹幕请求相同的超时，避免连接卡住时一直阻塞
+        response = _SESSION.get(api_url, timeout=(3, 30))
         response.raise_for_status()
         data = response.json()
 
@@ -57,6 +89,7 @@ def fetch_episode_list(drama_id: int) -> List[Dict[str, str]]:
         return []
 
 # 获取指定声音ID的弹幕XML数据。
-def fetch_danmaku_xml(sound_id: str) -> Optional[str]:
+def fetch_danmaku_xml(sound_id: str) -> Optional[bytes]:
     url = f"https://www.missevan.com/sound/getdm?soundid={sound_id}"
-    return fetch_page_content(url)
\ No newline at end of file
+    with _REQUEST_SEMAPHORE:
+        return fetch_page_bytes(url)
\ No newline at end of file
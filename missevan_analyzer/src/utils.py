@@ -1,28 +1,109 @@
 import csv
-from typing import List, Dict
+import math
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable
+
+# JSON解析优先使用orjson，未安装时退回标准库
+try:
+    import orjson
+except ImportError:
+    import json as orjson
 
 # 格式化时间字符串
 def format_time(seconds: float) -> str:
     if not isinstance(seconds, (int, float)):
         return "00:00"
-    minutes = int(seconds // 60)
-    seconds = int(seconds % 60)
+    # 先取整到秒再查缓存，同一集内的时间戳只有几千种取值
+    return _format_whole_seconds(math.floor(seconds))
+
+@lru_cache(maxsize=8192)
+def _format_whole_seconds(total_seconds: int) -> str:
+    minutes, seconds = divmod(total_seconds, 60)
     return f"{minutes:02d}:{seconds:02d}"
 
+# 批量格式化一组时间戳，省去逐条访问属性和类型检查的开销
+def format_times(timestamps: Iterable[float]) -> List[str]:
+    fmt = _format_whole_seconds
+    floor = math.floor
+    return [fmt(floor(t)) for t in timestamps]
+
 # 从csv文件中读取剧集名称和ID，返回剧集信息列表
 def read_drama_csv(file_path: str) -> List[Dict[str, str]]:
-    episodes = []
     try:
         with open(file_path, mode='r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            name_key = reader.fieldnames[0]
-            id_key = reader.fieldnames[1]
-            for row in reader:
-                episodes.append({'name': row[name_key], 'id': row[id_key]})
-        return episodes
+            # 前两列依次为名称和ID，直接按列读取，省去DictReader为每行额外构建的字典
+            reader = csv.reader(file)
+            next(reader, None)  # 跳过表头
+            return [{'name': row[0], 'id': row[1]} for row in reader if len(row) >= 2]
     except FileNotFoundError:
         print(f"错误: 文件未找到 - {file_path}")
         return []
     except Exception as e:
         print(f"读取CSV文件时发生错误: {e}")
-        return []
\ No newline at end of file
+        return []
+
+# 读取JSON文件，以二进制读入交给解析器处理编码
+def load_json(file_path: str) -> Any:
+    with open(file_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+# 工作线程为守护线程的线程池，用法与ThreadPoolExecutor相同；
+# 标准库线程池的线程会在解释器退出时被等待，关闭窗口后进程会一直等正在进行的网络请求结束
+class DaemonThreadPoolExecutor(Executor):
+    def __init__(self, max_workers: int, thread_name_prefix: str = "worker"):
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._work_queue = queue.SimpleQueue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("线程池已关闭，无法提交新任务")
+            future = Future()
+            self._work_queue.put((future, fn, args, kwargs))
+            if len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._worker, daemon=True,
+                                          name=f"{self._thread_name_prefix}_{len(self._threads)}")
+                thread.start()
+                self._threads.append(thread)
+            return future
+
+    def _worker(self) -> None:
+        while True:
+            item = self._work_queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                # 取消所有尚未开始的任务
+                while True:
+                    try:
+                        item = self._work_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item[0].cancel()
+            for _ in self._threads:
+                self._work_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()